@@ -1,20 +1,79 @@
 import os
-import requests
+import re
+import hashlib
 import zipfile
 import shutil
-import uuid
-from flask import Flask, render_template, request, jsonify, send_from_directory
+import secrets
+import struct
+import tempfile
+import threading
+import time
+import types
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Request, Response, render_template, request, jsonify, send_from_directory, url_for
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 from PIL import Image
 from supabase import create_client, Client
 from postgrest.exceptions import APIError # Import APIError
 
+# Raised by zipfile when an entry's deflate stream is corrupt.
+_inflate_errors = (zlib.error,)
+try:
+    # ISA-L's inflate is a drop-in for zlib's and 2-3x faster. zipfile looks up
+    # zlib.decompressobj at call time, so giving it a zlib whose decompressobj
+    # comes from ISA-L speeds up every compressed entry we read. Everything
+    # else stays stdlib: ISA-L only compresses at levels 0-3, so deflated
+    # writes must keep using zlib's compressobj.
+    from isal import isal_zlib
+    _inflate_zlib = types.ModuleType('zlib')
+    _inflate_zlib.__dict__.update(vars(zlib))
+    _inflate_zlib.decompressobj = isal_zlib.decompressobj
+    zipfile.zlib = _inflate_zlib
+    # isal_zlib.error isn't a subclass of zlib.error.
+    _inflate_errors += (isal_zlib.error,)
+except ImportError:
+    pass
+
 # --- Flask App Initialization ---
+class UploadRequest(Request):
+    """Spools uploaded files into UPLOAD_FOLDER rather than the system temp dir."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=500 * 1024, mode='rb+', dir=UPLOAD_FOLDER)
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 
 # --- Configuration ---
-UPLOAD_FOLDER = 'uploads'
+# Uploads are spooled and session zips built here. Point it at a tmpfs
+# (e.g. /dev/shm/artypacks) to keep that churn off the disk, as long as it has
+# room for a few sessions' zips.
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+# One .brushset per request, plus some room for the other form fields.
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE + 1024 * 1024
+MIN_STAMP_DIMENSION = 1024
+IMAGE_WORKERS = min(32, (os.cpu_count() or 4) * 2)
+COPY_BUFFER_SIZE = 256 * 1024
+MAX_UNCOMPRESSED_SIZE = 512 * 1024 * 1024
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Smallest a 1024x1024 image can possibly be on disk, so entries below these
+# sizes are skipped without being opened. Deliberately loose: a flat 1-bit
+# PNG of that size is ~200 bytes and a flat grayscale JPEG a few KB.
+MIN_STAMP_BYTES = {'.png': 128, '.jpg': 1024, '.jpeg': 1024}
+DOWNLOAD_TTL = 60 * 60
+# The page names sessions `session-<Date.now()>`; those are already safe filenames.
+SESSION_ID_PATTERN = re.compile(r'session-\d{1,20}')
+
+# --- Download Offloading ---
+# Let the front-end server send finished zips with sendfile() instead of a
+# worker streaming them: behind nginx, point X_ACCEL_REDIRECT_PREFIX at an
+# `internal` location aliased to UPLOAD_FOLDER; behind Apache with
+# mod_xsendfile, set USE_X_SENDFILE=1.
+X_ACCEL_REDIRECT_PREFIX = os.environ.get('X_ACCEL_REDIRECT_PREFIX')
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
 
 # --- Supabase Configuration ---
 SUPABASE_URL = os.environ.get('SUPABASE_URL')
@@ -25,39 +84,184 @@ if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
 
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
 
-# --- Brushset Processing Function (Unchanged) ---
-def process_brushset(filepath):
-    temp_extract_dir = os.path.join(UPLOAD_FOLDER, f"extract_{uuid.uuid4().hex}")
-    os.makedirs(temp_extract_dir, exist_ok=True)
-    image_paths = []
+# --- License Lookup ---
+# The page checks the key with /check-license right before a session, then
+# posts the same key once per file. The cache is per worker process: another
+# worker's validate_and_decrement doesn't clear it, so /check-license may show
+# a balance up to CHECK_LICENSE_MAX_AGE old. The first file of a session always
+# reads Supabase; later files reuse that row for a few minutes. This is safe
+# because the credit itself is re-validated atomically by validate_and_decrement.
+LICENSE_CACHE_TTL = 5 * 60
+CHECK_LICENSE_MAX_AGE = 15
+# Anything outside this can't be a key, so it's reported as not found without
+# a round trip; the page only starts checking once 8 characters are typed.
+LICENSE_KEY_PATTERN = re.compile(r'[A-Za-z0-9_-]{8,128}')
+_license_cache = {}
+_license_cache_lock = threading.Lock()
+
+def _cache_key(license_key):
+    # Keyed by digest so raw license keys aren't kept around in memory.
+    return hashlib.blake2b(license_key.encode(), digest_size=16).digest()
+
+def fetch_license(license_key, max_age=LICENSE_CACHE_TTL):
+    """Returns the licenses row for license_key, or None if there isn't one.
+
+    A cached row is reused if it was fetched less than max_age seconds ago.
+    Raises APIError for anything other than a missing row.
+    """
+    if not LICENSE_KEY_PATTERN.fullmatch(license_key):
+        return None
+    now = time.monotonic()
+    cache_key = _cache_key(license_key)
+    with _license_cache_lock:
+        cached = _license_cache.get(cache_key)
+    if cached and now - cached[0] < max_age:
+        return cached[1]
+    try:
+        response = supabase.from_('licenses').select('sessions_remaining, is_active').eq('license_key', license_key).single().execute()
+    except APIError as e:
+        if "No rows found" in e.message:
+            return None
+        raise
+    if response.data is not None:
+        with _license_cache_lock:
+            # Drop expired rows so the cache doesn't grow with every key ever seen.
+            for key in [k for k, (fetched, _) in _license_cache.items() if now - fetched >= LICENSE_CACHE_TTL]:
+                del _license_cache[key]
+            _license_cache[cache_key] = (now, response.data)
+    return response.data
+
+def forget_license(license_key):
+    with _license_cache_lock:
+        _license_cache.pop(_cache_key(license_key), None)
+
+# --- Brushset Processing Functions ---
+# Shared by all requests so threads aren't spawned and torn down per upload.
+image_pool = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix='brush-decode')
+
+def _is_candidate(info):
+    name = os.path.basename(info.filename).lower()
+    min_bytes = MIN_STAMP_BYTES.get(os.path.splitext(name)[1])
+    return (min_bytes is not None and not info.is_dir() and name != 'artwork.png'
+            and info.file_size >= min_bytes)
+
+def _stamp_size(brushset_zip, info):
+    """Returns the (width, height) of a zip entry, or None if it isn't an image.
+
+    Only the header is read, so the entry is never inflated past it. A corrupt
+    or truncated entry also gives None, so it only drops itself.
+    """
+    try:
+        with brushset_zip.open(info) as entry:
+            # A PNG's size sits at a fixed offset in its IHDR chunk, which must
+            # come first; read it directly and skip Pillow entirely.
+            header = entry.read(24)
+            if header[:8] == PNG_SIGNATURE and header[12:16] == b'IHDR':
+                width, height = struct.unpack('>II', header[16:24])
+                # Same limit Pillow's DecompressionBombError applies to JPEGs.
+                if width * height > 2 * Image.MAX_IMAGE_PIXELS:
+                    return None
+                return width, height
+            entry.seek(0)
+            with Image.open(entry, formats=('PNG', 'JPEG')) as img:
+                return img.size
+    except (IOError, SyntaxError, struct.error, zipfile.BadZipFile, Image.DecompressionBombError) + _inflate_errors:
+        return None
+
+def _is_stamp_size(size):
+    return size is not None and size[0] >= MIN_STAMP_DIMENSION and size[1] >= MIN_STAMP_DIMENSION
+
+def _copy_entry(brushset_zip, info, out_zip, arcname):
+    zinfo = zipfile.ZipInfo(arcname, date_time=info.date_time)
+    # Declaring the size up front lets zipfile pick ZIP64 only when needed.
+    zinfo.file_size = info.file_size
+    with brushset_zip.open(info) as src, out_zip.open(zinfo, 'w') as dest:
+        shutil.copyfileobj(src, dest, COPY_BUFFER_SIZE)
+
+def _unused_prefix(out_zip, name_prefix):
+    """Returns name_prefix, suffixed if another brushset already used it."""
+    stems = {os.path.splitext(name)[0] for name in out_zip.namelist()}
+    prefix, copy = name_prefix, 1
+    while f"{prefix}_1" in stems:
+        copy += 1
+        prefix = f"{name_prefix}-{copy}"
+    return prefix
+
+def process_brushset(brushset_file, out_zip, name_prefix):
+    """Copies the stamp images (min 1024px) of a .brushset file object into out_zip.
+
+    Stamps go straight from the uploaded archive into the session's output
+    zip as {name_prefix}_{n}.png (or .jpg), so nothing is staged on disk.
+    Returns (arcnames, error_message) for problems with the upload itself;
+    anything unexpected is raised. On error, out_zip may hold partial output.
+    """
     try:
-        with zipfile.ZipFile(filepath, 'r') as brushset_zip:
-            brushset_zip.extractall(temp_extract_dir)
-            for root, _, files in os.walk(temp_extract_dir):
-                for name in files:
-                    if name.lower().endswith(('.png', '.jpg', '.jpeg')) and name.lower() != 'artwork.png':
-                        try:
-                            img_path = os.path.join(root, name)
-                            with Image.open(img_path) as img:
-                                if img.width >= 1024 and img.height >= 1024:
-                                    image_paths.append(img_path)
-                        except (IOError, SyntaxError):
-                            continue
-        image_paths.sort()
-        return image_paths, None, temp_extract_dir
+        # Passing an open file keeps zipfile from closing the shared handle
+        # while worker threads still have entries open.
+        with zipfile.ZipFile(brushset_file, 'r') as brushset_zip:
+            infos = brushset_zip.infolist()
+            # Zip-bomb guard: the central directory already lists every entry's
+            # sizes, so this costs nothing on a legitimate brushset. There is
+            # no compression-ratio limit: stamps saved as uncompressed PNGs
+            # legitimately shrink by far more than any sane bomb threshold.
+            if sum(info.file_size for info in infos) > MAX_UNCOMPRESSED_SIZE:
+                return None, "This brushset is too large to convert."
+            # infolist() is in archive order and map() keeps it, so stamps are
+            # numbered in the order they appear in the brushset.
+            candidates = [info for info in infos if _is_candidate(info)]
+            # Brushes often share a stamp image. The central directory already
+            # has each entry's CRC and size, so identical copies are probed once.
+            distinct = {}
+            for info in candidates:
+                distinct.setdefault((info.CRC, info.file_size), info)
+            # Each entry is independent and zlib/PIL release the GIL while
+            # decoding, so entries are probed side by side.
+            sizes = dict(zip(distinct, image_pool.map(lambda info: _stamp_size(brushset_zip, info), distinct.values())))
+            stamps = [
+                info for info in candidates
+                if _is_stamp_size(sizes[(info.CRC, info.file_size)])
+            ]
+            prefix = _unused_prefix(out_zip, name_prefix)
+            arcnames = []
+            # A zip can only take one member write at a time.
+            for n, info in enumerate(stamps, start=1):
+                arcname = f"{prefix}_{n}{os.path.splitext(info.filename)[1].lower()}"
+                _copy_entry(brushset_zip, info, out_zip, arcname)
+                arcnames.append(arcname)
+        return arcnames, None
     except zipfile.BadZipFile:
-        shutil.rmtree(temp_extract_dir, ignore_errors=True)
-        return None, "This file seems to be corrupted or isn't a valid .brushset.", None
-    except Exception as e:
-        print(f"Error processing brushset: {e}")
-        shutil.rmtree(temp_extract_dir, ignore_errors=True)
-        return None, "Something went wrong on our end. Please try again in a moment.", None
+        return None, "This file seems to be corrupted or isn't a valid .brushset."
+
+def remove_stale_downloads():
+    """Deletes finished and in-progress zips older than DOWNLOAD_TTL.
+
+    Catches downloads that were never fetched, sessions that were abandoned
+    part-way, and offloaded downloads, which the app can't delete itself
+    since it never sees the transfer finish.
+    """
+    cutoff = time.time() - DOWNLOAD_TTL
+    with os.scandir(UPLOAD_FOLDER) as entries:
+        for entry in entries:
+            if not (entry.name.startswith('converted_') and entry.name.endswith(('.zip', '.zip.part'))):
+                continue
+            # Sweeps can overlap, so the file may already be gone.
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
 
 # --- Main Flask Routes ---
 @app.route('/')
 def home():
     return render_template('index.html')
 
+# The page reads every error as JSON, so oversize uploads (rejected by
+# MAX_CONTENT_LENGTH before they're read) need a JSON body too.
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    return jsonify({"message": f"This file is too large. Each .brushset must be under {MAX_UPLOAD_SIZE // (1024 * 1024)} MB."}), 413
+
 # --- CORRECTED Route to check license balance ---
 @app.route('/check-license')
 def check_license():
@@ -65,22 +269,132 @@ def check_license():
     if not license_key:
         return jsonify({"message": "License key is required."}), 400
     try:
-        # The execute() call is now outside the main try block for specific error handling
-        response = supabase.from_('licenses').select('sessions_remaining, is_active').eq('license_key', license_key).single().execute()
-        
-        # The .single() method ensures that if no row is found, it raises an error
-        # that we can catch, but for robustness, we also check the data.
-        if response.data is None:
-            return jsonify({"message": "That license key wasn't found. Please check for typos."}), 404
+        key_data = fetch_license(license_key, max_age=CHECK_LICENSE_MAX_AGE)
+    except APIError as e:
+        # fetch_license already turns "No rows found" into None; anything else
+        # is logged and kept from the user.
+        print(f"Supabase API error: {e.message}")
+        return jsonify({"message": "Something went wrong on our end. Please try again in a moment."}), 500
+
+    if key_data is None:
+        return jsonify({"message": "That license key wasn't found. Please check for typos."}), 404
+    if not key_data.get('is_active'):
+        return jsonify({"message": "Your license isn't active yet. Please check your email."}), 403
+
+    return jsonify({"remaining": key_data.get('sessions_remaining', 0)})
 
-        key_data = response.data
-        if not key_data.get('is_active'):
-            return jsonify({"message": "Your license isn't active yet. Please check your email."}), 403
+# --- Route to convert one .brushset of a multi-file session ---
+@app.route('/convert', methods=['POST'])
+def convert():
+    license_key = request.form.get('license_key')
+    session_id = request.form.get('session_id')
+    is_first_file = request.form.get('is_first_file') == 'true'
+    is_last_file = request.form.get('is_last_file') == 'true'
+    uploaded_file = request.files.get('brush_file')
 
-        return jsonify({"remaining": key_data.get('sessions_remaining', 0)})
+    if not license_key or not session_id or not uploaded_file:
+        return jsonify({"message": "Some information was missing. Please refresh the page and try again."}), 400
+    if not uploaded_file.filename.lower().endswith('.brushset'):
+        return jsonify({"message": "Please choose .brushset files only."}), 400
 
+    try:
+        key_data = fetch_license(license_key, max_age=0 if is_first_file else LICENSE_CACHE_TTL)
     except APIError as e:
-        # This specifically catches the "No rows found" error from .single()
-        if "No rows found" in e.message:
-             return jsonify({"message": "That license key wasn't found. Please check for typos."}), 404
-        # For
+        print(f"Supabase API error: {e.message}")
+        return jsonify({"message": "Something went wrong on our end. Please try again in a moment."}), 500
+
+    if key_data is None:
+        return jsonify({"message": "That license key wasn't found. Please check for typos."}), 404
+    if not key_data.get('is_active'):
+        return jsonify({"message": "Your license isn't active yet. Please check your email."}), 403
+    if key_data.get('sessions_remaining', 0) <= 0:
+        return jsonify({"message": "You don't have any conversions left on this license."}), 403
+
+    safe_session = session_id if SESSION_ID_PATTERN.fullmatch(session_id) else secure_filename(session_id)
+    # Each file of the session is appended to this zip as it arrives; the last
+    # file renames it into place.
+    part_zip_path = os.path.join(UPLOAD_FOLDER, f"converted_{safe_session}.zip.part")
+
+    original_filename = secure_filename(uploaded_file.filename)
+    brush_basename = os.path.splitext(original_filename)[0] or 'brushset'
+    # Append mode would quietly start a new zip over a missing session zip (or
+    # after an unreadable one), dropping the files converted so far.
+    if not is_first_file and not zipfile.is_zipfile(part_zip_path):
+        return jsonify({"message": "This conversion session has expired. Please start again."}), 400
+    try:
+        # Stamps are PNG/JPEG data that is already compressed, so they are
+        # stored as-is; deflating them again costs CPU for no real size gain.
+        # The upload is read in place: UploadRequest has already spooled it to
+        # a seekable temp file, so there is no need to copy it out first.
+        with zipfile.ZipFile(part_zip_path, 'w' if is_first_file else 'a',
+                             compression=zipfile.ZIP_STORED, allowZip64=True) as session_zip:
+            images, error = process_brushset(uploaded_file.stream, session_zip, brush_basename)
+    except Exception as e:
+        print(f"Error processing brushset: {e}")
+        try:
+            os.remove(part_zip_path)
+        except OSError:
+            pass
+        return jsonify({"message": "Something went wrong on our end. Please try again in a moment."}), 500
+
+    if error or not images:
+        os.remove(part_zip_path)
+        message = error or f"We couldn't find any stamp images (min 1024px) in {uploaded_file.filename}."
+        return jsonify({"message": message}), 400
+
+    if not is_last_file:
+        return jsonify({"message": "File processed successfully."})
+
+    # The sweep only touches other sessions' old files, so it needn't hold up
+    # this response.
+    threading.Thread(target=remove_stale_downloads, daemon=True).start()
+    # Session ids come from the client and are just timestamps, so the
+    # download name gets a server-side secret; it may be fetched more than
+    # once until DOWNLOAD_TTL when downloads are offloaded.
+    final_zip_filename = f"converted_{safe_session}_{secrets.token_urlsafe(16)}.zip"
+    final_zip_path = os.path.join(UPLOAD_FOLDER, final_zip_filename)
+    os.replace(part_zip_path, final_zip_path)
+
+    # The credit is only consumed once the conversion has fully succeeded.
+    # validate_and_decrement (supabase/migrations) re-checks the license and
+    # takes the credit in one atomic UPDATE, returning the new balance, or NULL
+    # if the license is inactive or already out of credits (e.g. spent by a
+    # parallel session). No credit taken means no download.
+    try:
+        remaining = supabase.rpc('validate_and_decrement', {'key_to_update': license_key}).execute().data
+    except APIError as e:
+        print(f"CRITICAL: Failed to take the credit for a finished session: {e.message}")
+        os.remove(final_zip_path)
+        return jsonify({"message": "Something went wrong on our end. Please try again in a moment."}), 500
+    finally:
+        forget_license(license_key)
+
+    if remaining is None:
+        os.remove(final_zip_path)
+        return jsonify({"message": "You don't have any conversions left on this license."}), 403
+
+    return jsonify({"download_url": url_for('download_zip', filename=final_zip_filename), "remaining": remaining})
+
+# --- Route to download the finished zip ---
+@app.route('/download-zip/<filename>')
+def download_zip(filename):
+    safe_filename = secure_filename(filename)
+    path = os.path.join(UPLOAD_FOLDER, safe_filename)
+    # Only finished zips are served, never a session's .part or a spooled upload.
+    if not (safe_filename.startswith('converted_') and safe_filename.endswith('.zip')) or not os.path.exists(path):
+        return jsonify({"message": "This download has expired. Please convert your files again."}), 404
+    if X_ACCEL_REDIRECT_PREFIX:
+        response = Response(mimetype='application/zip')
+        response.headers['X-Accel-Redirect'] = f"{X_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{safe_filename}"
+        response.headers['Content-Disposition'] = 'attachment; filename="Artypacks_Conversion.zip"'
+        return response
+    response = send_from_directory(UPLOAD_FOLDER, safe_filename, as_attachment=True, download_name='Artypacks_Conversion.zip', conditional=True)
+    # Only a full GET consumes the download; HEAD, Range (206) and 304
+    # responses leave it for the client to come back, and for the stale sweep.
+    if not app.config['USE_X_SENDFILE'] and request.method == 'GET' and response.status_code == 200:
+        # The response already holds an open handle, so the name can be
+        # unlinked now: the data stays readable until the body is sent and the
+        # handle closed. Done on a side thread so a slow unlink doesn't delay
+        # the response.
+        threading.Thread(target=os.remove, args=(path,), daemon=True).start()
+    return response
@@ -0,0 +1,12 @@
+-- Re-checks a license and takes one credit in a single atomic UPDATE.
+-- Returns the new sessions_remaining, or NULL if the license is unknown,
+-- inactive or already out of credits. Called by /convert on a session's last file.
+create or replace function validate_and_decrement(key_to_update text)
+returns integer language sql as $$
+  update licenses
+     set sessions_remaining = sessions_remaining - 1
+   where license_key = key_to_update
+     and is_active
+     and sessions_remaining > 0
+  returning sessions_remaining;
+$$;